@@ -1,14 +1,21 @@
 """Tests behavior related to migrations"""
+import os
 import pathlib
-import shutil
 import time
+from typing import Union
 
 import ddf
 import django.contrib.auth.models as auth_models
 import pytest
 from django.apps import apps
 from django.core.management import call_command
-from django.db import models
+from django.core.management.commands import makemigrations
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.questioner import NonInteractiveMigrationQuestioner
+from django.db.migrations.state import ProjectState
+from django.db.migrations.writer import MigrationWriter
 from django.db.utils import ProgrammingError
 
 import pgtrigger
@@ -16,18 +23,102 @@ import pgtrigger.tests.models as test_models
 from pgtrigger import core
 from pgtrigger.tests import utils
 
+MIGRATION_DIR = pathlib.Path(__file__).resolve().parent / "migrations"
+
 
 @pytest.fixture(autouse=True)
 def disble_install_on_migrate(settings):
     settings.PGTRIGGER_INSTALL_ON_MIGRATE = False
 
 
-def migration_dir():
-    return pathlib.Path(__file__).parent / "migrations"
+def num_migration_files():
+    with os.scandir(MIGRATION_DIR) as entries:
+        return sum(
+            1 for entry in entries if entry.name.startswith("0") and entry.name.endswith(".py")
+        )
 
 
-def num_migration_files():
-    return len(list(migration_dir().glob("0*.py")))
+class MigrationCounter:
+    """Tracks the expected number of migration files in the test migration dir"""
+
+    def __init__(self, num_orig):
+        self.orig = self.expected = num_orig
+
+    def bump(self):
+        """Expect a new migration file and return the expected number of files"""
+        self.expected += 1
+        return self.expected
+
+
+@pytest.fixture
+def migration_counter(num_orig_migrations):
+    return MigrationCounter(num_orig_migrations)
+
+
+class MigrationHelper:
+    """Makes and applies migrations in-process.
+
+    This avoids the command parsing of `call_command("makemigrations")`
+    and `call_command("migrate")` for the later steps of the migration
+    tests. The initial migrations and the first added trigger still go
+    through the real commands. Like the migrate command, `post_migrate`
+    is emitted with the post-migration apps and the plan. The autodetector
+    is the one patched by pgtrigger for the makemigrations command, so
+    trigger operations are still detected.
+
+    The executor's loader is reused for every call. Its graph is rebuilt
+    from disk before each operation to pick up newly-written migrations.
+    """
+
+    def __init__(self, database=DEFAULT_DB_ALIAS):
+        self.executor = MigrationExecutor(connections[database])
+
+    def detect_changes(self, name=None):
+        """Return the migrations needed for any model changes, keyed by app"""
+        loader = self.executor.loader
+        loader.build_graph()
+        autodetector = makemigrations.MigrationAutodetector(
+            loader.project_state(),
+            ProjectState.from_apps(apps),
+            NonInteractiveMigrationQuestioner(),
+        )
+        return autodetector.changes(graph=loader.graph, migration_name=name)
+
+    def makemigrations(self, name=None):
+        """Write migrations for any model changes and return the migrations"""
+        written = []
+        for app_migrations in self.detect_changes(name=name).values():
+            for migration in app_migrations:
+                writer = MigrationWriter(migration)
+                with open(writer.path, "w", encoding="utf-8") as f:
+                    f.write(writer.as_string())
+                written.append(migration)
+
+        return written
+
+    def migrate(self, app_label=None, migration_prefix=None):
+        """Migrate to the given migration, or to the latest migrations of all apps"""
+        loader = self.executor.loader
+        loader.build_graph()
+        if app_label:
+            migration = loader.get_migration_by_prefix(app_label, migration_prefix)
+            targets = [(app_label, migration.name)]
+        else:
+            targets = loader.graph.leaf_nodes()
+
+        plan = self.executor.migration_plan(targets)
+        post_migrate_state = self.executor.migrate(targets, plan=plan)
+        post_migrate_state.clear_delayed_apps_cache()
+        emit_post_migrate_signal(
+            0, False, self.executor.connection.alias, apps=post_migrate_state.apps, plan=plan
+        )
+
+
+@pytest.fixture(scope="module")
+def migration_helper(django_db_setup, django_db_blocker):
+    """A migration helper whose loader is shared by the tests in this module"""
+    with django_db_blocker.unblock():
+        return MigrationHelper()
 
 
 @pytest.fixture
@@ -40,26 +131,33 @@ def reset_triggers():
     pgtrigger.install(database="default")
 
 
+@pytest.fixture(scope="session")
+def pristine_migrations():
+    """The file names of the checked-in migrations, read once per session"""
+    return frozenset(path.name for path in MIGRATION_DIR.glob("*.py"))
+
+
+@pytest.fixture(scope="session")
+def num_orig_migrations(pristine_migrations):
+    """The number of checked-in migrations"""
+    return sum(1 for name in pristine_migrations if name.startswith("0"))
+
+
 @pytest.fixture
-def reset_migrations(tmp_path, request):
+def reset_migrations(num_orig_migrations, migration_helper, pristine_migrations):
     """Ensures the migration dir is reset after the test"""
-    num_orig_migrations = num_migration_files()
-    shutil.copytree(migration_dir(), tmp_path / "migrations")
-
     try:
         yield
     finally:
         # Migrate back to the initial migration of the test to allevitate
         # some of the issues when re-using a test DB
-        call_command(
-            "migrate",
-            "tests",
-            str(num_orig_migrations).rjust(4, "0"),
-            verbosity=request.config.option.verbose,
-        )
+        migration_helper.migrate("tests", str(num_orig_migrations).rjust(4, "0"))
 
-        shutil.rmtree(migration_dir())
-        shutil.copytree(tmp_path / "migrations", migration_dir())
+        # Tests only create migrations, so removing the new ones resets the dir
+        with os.scandir(MIGRATION_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith(".py") and entry.name not in pristine_migrations:
+                    os.unlink(entry.path)
 
 
 def assert_all_triggers_installed():
@@ -68,28 +166,62 @@ def assert_all_triggers_installed():
         assert status[0] == core.INSTALLED
 
 
+def make_migrations(atomic: Union[bool, None] = None):
+    """Call makemigrations. Set atomic property of last migration if it is specified"""
+    name = f"a{time.time()}".replace(".", "")
+    call_command("makemigrations", name=name)
+    if atomic is None:
+        return
+
+    (last_migration,) = MIGRATION_DIR.glob(f"*_{name}.py")
+
+    with open(last_migration, "r") as f:
+        contents = f.read()
+
+    contents = contents.replace(
+        "class Migration(migrations.Migration):\n",
+        f"class Migration(migrations.Migration):\n    atomic = {atomic}\n",
+    )
+    with open(last_migration, "w") as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def atomic():
+    """The atomic property of made migrations. Parametrized by tests that set it"""
+    return None
+
+
+@pytest.fixture
+def migrated_baseline(
+    settings,
+    reset_triggers,
+    reset_migrations,
+    migration_counter,
+    atomic,
+):
+    """Makes and applies the initial trigger migrations for existing models"""
+    # Verify that we've configured our test settings properly
+    assert not settings.PGTRIGGER_INSTALL_ON_MIGRATE
+    assert settings.PGTRIGGER_MIGRATIONS
+
+    make_migrations(atomic)
+    assert num_migration_files() == migration_counter.bump()
+
+    call_command("migrate")
+    assert_all_triggers_installed()
+
+
 @pytest.mark.django_db(
     databases=["default", "other", "receipt", "order", "sqlite"], transaction=True
 )
-@pytest.mark.usefixtures("reset_triggers", "reset_migrations")
+@pytest.mark.usefixtures("migrated_baseline")
 @pytest.mark.order(-1)  # This is a possibly leaky test if it fails midway. Always run last
-def test_makemigrations_existing_models(settings, request):
+def test_makemigrations_existing_models(migration_counter, migration_helper):
     """
     Create migrations for existing models and test various scenarios
     where triggers are dynamically added and removed
     """
-    # Verify that we've configured our test settings properly
-    assert not settings.PGTRIGGER_INSTALL_ON_MIGRATE
-    assert settings.PGTRIGGER_MIGRATIONS
-
-    num_orig_migrations = num_migration_files()
-
-    call_command("makemigrations", verbosity=request.config.option.verbose)
-    assert num_migration_files() == num_orig_migrations + 1
-
-    call_command("migrate", verbosity=request.config.option.verbose)
-    assert_all_triggers_installed()
-
     # Add a new trigger to the registry that should be migrated
     trigger = pgtrigger.Trigger(
         when=pgtrigger.Before,
@@ -99,17 +231,16 @@ def test_makemigrations_existing_models(settings, request):
     )
 
     with trigger.register(test_models.TestModel):
-        call_command("makemigrations", verbosity=request.config.option.verbose)
-        assert num_migration_files() == num_orig_migrations + 2
+        call_command("makemigrations")
+        assert num_migration_files() == migration_counter.bump()
 
         # As a sanity check, ensure makemigrations doesnt make dups
-        call_command("makemigrations", verbosity=request.config.option.verbose)
-        assert num_migration_files() == num_orig_migrations + 2
+        assert not migration_helper.detect_changes()
 
         # Before migrating, I should be able to make a `TestModel`
-        ddf.G("tests.TestModel")
+        test_models.TestModel.objects.create()
 
-        call_command("migrate", verbosity=request.config.option.verbose)
+        call_command("migrate")
         assert_all_triggers_installed()
 
         # After migrating, test models should be protected
@@ -119,28 +250,31 @@ def test_makemigrations_existing_models(settings, request):
         # Update the trigger to allow inserts, but not updates.
         # We should have a new migration
         trigger.operation = pgtrigger.Update
-        call_command("makemigrations", verbosity=request.config.option.verbose)
-        assert num_migration_files() == num_orig_migrations + 3
+        migration_helper.makemigrations()
+        assert num_migration_files() == migration_counter.bump()
 
-        call_command("migrate", verbosity=request.config.option.verbose)
+        migration_helper.migrate()
         assert_all_triggers_installed()
 
         # We should be able to make test models but not update them
-        test_model = ddf.G("tests.TestModel")
+        test_model = test_models.TestModel.objects.create()
         with utils.raises_trigger_error(match="no no no!"):
             test_model.save()
 
     # The trigger is now removed from the registry. It should create
     # a new migration
-    call_command("makemigrations", verbosity=request.config.option.verbose)
-    assert num_migration_files() == num_orig_migrations + 4
+    (migration,) = migration_helper.makemigrations()
+    assert num_migration_files() == migration_counter.bump()
+    assert [operation.describe() for operation in migration.operations] == [
+        "Remove trigger my_migrated_trigger from model testmodel"
+    ]
 
-    call_command("migrate", verbosity=request.config.option.verbose)
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # We should be able to create and update the test model now that
     # the trigger is removed
-    test_model = ddf.G("tests.TestModel")
+    test_model = test_models.TestModel.objects.create()
     test_model.save()
 
     # Create a protection trigger on the external user model and
@@ -159,94 +293,77 @@ def test_makemigrations_existing_models(settings, request):
         condition=pgtrigger.Q(new__char_field="%"),
     )
     with trigger.register(test_models.TestModel):
-        call_command("makemigrations", verbosity=request.config.option.verbose)
-        assert num_migration_files() == num_orig_migrations + 5
+        migration_helper.makemigrations()
+        assert num_migration_files() == migration_counter.bump()
 
-        call_command("migrate", verbosity=request.config.option.verbose)
+        migration_helper.migrate()
         assert_all_triggers_installed()
 
-        tm = ddf.G("tests.TestModel", char_field="hello")
+        tm = test_models.TestModel.objects.create(char_field="hello")
 
         with utils.raises_trigger_error(match="Cannot update rows"):
             tm.char_field = "%"
             tm.save()
 
 
-def make_migrations(atomic: bool):
-    """Call makemigrations. Set atomic property of last migration if it is specified"""
-    call_command("makemigrations", name=f"a{time.time()}".replace(".", ""))
-
-    last_migration = sorted(pathlib.Path(migration_dir()).glob("[0-9]*.py"))[-1]
-    with open(last_migration, "r") as f:
-        contents = f.read()
-
-    contents = contents.replace(
-        "class Migration(migrations.Migration):\n",
-        f"class Migration(migrations.Migration):\n    atomic = {atomic}\n",
-    )
-    with open(last_migration, "w") as f:
-        f.write(contents)
+# Abstract models are not added to the app registry, so the base of the
+# dynamic test models can be built once at import
+class BaseDynamicTestModel(models.Model):
+    field = models.CharField(max_length=120)
+    user = models.ForeignKey(auth_models.User, on_delete=models.CASCADE)
+
+    class Meta:
+        abstract = True
+        triggers = [
+            pgtrigger.Protect(
+                name="protect_deletes",
+                operation=pgtrigger.Delete,
+                condition=~pgtrigger.Q(old__field="nothing"),
+            ),
+            pgtrigger.Protect(
+                name="protect_updates",
+                operation=pgtrigger.Update,
+                condition=~pgtrigger.Q(old__field="nothing"),
+            ),
+        ]
+
+
+def remove_test_model(model):
+    """Remove a dynamically-created model from the test app.
+
+    The whole app registry cache is cleared so that reverse relations on
+    related models, such as `auth.User`, no longer reference the removed model.
+    """
+    delattr(test_models, model.__name__)
+    del apps.app_configs["tests"].models[model._meta.model_name]
+    apps.clear_cache()
 
 
 @pytest.mark.django_db(
     databases=["default", "other", "receipt", "order", "sqlite"], transaction=True
 )
-@pytest.mark.usefixtures("reset_triggers", "reset_migrations")
+@pytest.mark.usefixtures("migrated_baseline")
 @pytest.mark.order(-1)  # This is a possibly leaky test if it fails midway. Always run last
 # Run independently of core test suite since since this creates/removes models
 @pytest.mark.independent
 @pytest.mark.parametrize("atomic", [True, False])
-def test_makemigrations_create_remove_models(settings, atomic):
+def test_makemigrations_create_remove_models(atomic, migration_counter, migration_helper):
     """
     Tests migration scenarios where models are dynamically added and
     removed.
     """
-    assert not settings.PGTRIGGER_INSTALL_ON_MIGRATE
-    assert settings.PGTRIGGER_MIGRATIONS
-
-    num_orig_migrations = num_migration_files()
-    num_expected_migrations = num_orig_migrations
-
-    ###
-    # Make the initial trigger migrations
-    ###
-    make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
-    assert_all_triggers_installed()
 
     ###
     # Create a new model, migrate it, and verify triggers
     ###
-    class BaseDynamicTestModel(models.Model):
-        field = models.CharField(max_length=120)
-        user = models.ForeignKey(auth_models.User, on_delete=models.CASCADE)
-
-        class Meta:
-            abstract = True
-            triggers = [
-                pgtrigger.Protect(
-                    name="protect_deletes",
-                    operation=pgtrigger.Delete,
-                    condition=~pgtrigger.Q(old__field="nothing"),
-                ),
-                pgtrigger.Protect(
-                    name="protect_updates",
-                    operation=pgtrigger.Update,
-                    condition=~pgtrigger.Q(old__field="nothing"),
-                ),
-            ]
-
     class DynamicTestModel(BaseDynamicTestModel):
         pass
 
     test_models.DynamicTestModel = DynamicTestModel
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # Sanity check that we cannot delete or update a DynamicTestModel
@@ -270,9 +387,8 @@ def test_makemigrations_create_remove_models(settings, atomic):
     test_models.DynamicTestModel = DynamicTestModel
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # Sanity check that we cannot delete or update a DynamicTestModel
@@ -294,9 +410,8 @@ def test_makemigrations_create_remove_models(settings, atomic):
     DynamicTestModel._meta.original_attrs["triggers"] = DynamicTestModel._meta.triggers
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # Updates work, but deletes dont
@@ -309,14 +424,11 @@ def test_makemigrations_create_remove_models(settings, atomic):
     ###
     # Remove the model and verify it migrates
     ###
-    del test_models.DynamicTestModel
-    del apps.app_configs["tests"].models["dynamictestmodel"]
-    apps.clear_cache()
+    remove_test_model(DynamicTestModel)
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     with pytest.raises(ProgrammingError):
@@ -325,7 +437,7 @@ def test_makemigrations_create_remove_models(settings, atomic):
     # Unapply migration where a model with a trigger is removed
     # Any triggers that were defined on the model when it was removed should be
     # recreated.
-    call_command("migrate", "tests", str(num_expected_migrations - 1).rjust(4, "0"))
+    migration_helper.migrate("tests", str(migration_counter.expected - 1).rjust(4, "0"))
 
     test_models.DynamicTestModel = DynamicTestModel
     protected_model = ddf.G(test_models.DynamicTestModel)
@@ -334,7 +446,7 @@ def test_makemigrations_create_remove_models(settings, atomic):
     del test_models.DynamicTestModel
 
     # Reapply the migration we just unapplied
-    call_command("migrate")
+    migration_helper.migrate()
 
     # Create a new proxy model on a third-party app and add it to the test models
     class DynamicProxyModel(auth_models.User):
@@ -348,13 +460,12 @@ def test_makemigrations_create_remove_models(settings, atomic):
     test_models.DynamicProxyModel = DynamicProxyModel
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # Sanity check that we cannot delete or update a user
-    protected_model = ddf.G(auth_models.User)
+    protected_model = auth_models.User.objects.create(username="proxy_user")
 
     with utils.raises_trigger_error(match="Cannot update"):
         protected_model.username = "wes"
@@ -372,9 +483,8 @@ def test_makemigrations_create_remove_models(settings, atomic):
     DynamicProxyModel._meta.original_attrs["triggers"] = DynamicProxyModel._meta.triggers
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # Updates work, but deletes dont
@@ -387,14 +497,11 @@ def test_makemigrations_create_remove_models(settings, atomic):
     ###
     # Remove the proxy model and verify it migrates
     ###
-    del test_models.DynamicProxyModel
-    del apps.app_configs["tests"].models["dynamicproxymodel"]
-    apps.clear_cache()
+    remove_test_model(DynamicProxyModel)
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # We can delete the original model
@@ -413,17 +520,16 @@ def test_makemigrations_create_remove_models(settings, atomic):
     test_models.DynamicThroughModel = DynamicThroughModel
 
     # Sanity check that we cannot insert or delete a group
-    protected_model = ddf.G(auth_models.User)
-    protected_model.groups.add(ddf.G(auth_models.Group))
+    protected_model = auth_models.User.objects.create(username="through_user")
+    protected_model.groups.add(auth_models.Group.objects.create(name="group1"))
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     with utils.raises_trigger_error(match="Cannot insert"):
-        protected_model.groups.add(ddf.G(auth_models.Group))
+        protected_model.groups.add(auth_models.Group.objects.create(name="group2"))
 
     with utils.raises_trigger_error(match="Cannot delete"):
         protected_model.groups.clear()
@@ -437,26 +543,22 @@ def test_makemigrations_create_remove_models(settings, atomic):
     DynamicThroughModel._meta.original_attrs["triggers"] = DynamicThroughModel._meta.triggers
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # Inserts work, but deletes dont
-    protected_model.groups.add(ddf.G(auth_models.Group))
+    protected_model.groups.add(auth_models.Group.objects.create(name="group3"))
 
     with utils.raises_trigger_error(match="Cannot delete"):
         protected_model.groups.clear()
 
     # Remove the model and verify it migrates
-    del test_models.DynamicThroughModel
-    del apps.app_configs["tests"].models["dynamicthroughmodel"]
-    apps.clear_cache()
+    remove_test_model(DynamicThroughModel)
 
     make_migrations(atomic)
-    num_expected_migrations += 1
-    assert num_migration_files() == num_expected_migrations
-    call_command("migrate")
+    assert num_migration_files() == migration_counter.bump()
+    migration_helper.migrate()
     assert_all_triggers_installed()
 
     # We can delete the groups
@@ -465,4 +567,4 @@ def test_makemigrations_create_remove_models(settings, atomic):
     # Django has a known issue with using a default through model as a base in
     # migrations. We revert the migrations we just made up until the through model
     # so that the test doesn't pass when it cleans up all migrations
-    call_command("migrate", "tests", str(num_orig_migrations + 8).rjust(4, "0"))
+    migration_helper.migrate("tests", str(migration_counter.orig + 8).rjust(4, "0"))
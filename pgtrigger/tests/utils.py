@@ -7,14 +7,16 @@ from django.db.utils import DatabaseError
 
 
 @contextlib.contextmanager
-def raises_trigger_error(match=None, database=DEFAULT_DB_ALIAS, transaction=None):
-    with contextlib.ExitStack() as stack:
-        stack.enter_context(pytest.raises(DatabaseError, match=match))
+def raises_trigger_error(match="", database=DEFAULT_DB_ALIAS, transaction=None):
+    """Expect a database error whose message contains the `match` substring"""
+    with pytest.raises(DatabaseError) as exc_info:
+        with contextlib.ExitStack() as stack:
+            if transaction is None:
+                transaction = connections[database].in_atomic_block
 
-        if transaction is None:
-            transaction = connections[database].in_atomic_block
+            if transaction:
+                stack.enter_context(db_transaction.atomic(using=database))
 
-        if transaction:
-            stack.enter_context(db_transaction.atomic(using=database))
+            yield
 
-        yield
+    assert match in str(exc_info.value)